@@ -1,16 +1,39 @@
+from __future__ import annotations
+
 from configparser import ConfigParser
 import click
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain, islice
+from operator import attrgetter
+import os
 from pathlib import Path
-import psycopg2
-from typing import List
-import yaml
+from typing import Iterable, Iterator, List, TYPE_CHECKING
 
 from utils.dataclasses import Module, Resource
+from utils.streams import IteratorReader
+
+# psycopg2 and yaml are only imported when actually needed, so that the
+# command line can be parsed (or its help displayed) without loading them
+if TYPE_CHECKING:
+    import psycopg2.extensions
 
 '''Set program's verbosity. True to display actions on execution'''
 isVerbose = False
 
+'''Number of resources from which they are recorded using COPY'''
+COPY_THRESHOLD = 50
+
+'''Characters escaped in COPY text format'''
+COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\', '\n': '\\n', '\r': '\\r', '\t': '\\t'})
+
+'''Number of resource files read concurrently'''
+READ_WORKERS = min(32, (os.cpu_count() or 1) * 4)
 
+
+@lru_cache(maxsize=1)
 def extract_config(filename='database.ini', section='postgresql') -> dict:
     '''Extract all configuration information
     
@@ -42,40 +65,66 @@ def extract_config(filename='database.ini', section='postgresql') -> dict:
     return db
 
 
-def get_resources(path: Path) -> List[Resource]:
-    '''Retrieve all html resources inside the module folder
+def get_resources(path: Path) -> List[Path]:
+    '''Retrieve all html resource files inside the module folder
     
     :param path: Path of the folder in which look for all resources
     
-    :return: A list of all found resources as objects
+    :return: A list of all found resource files, not read yet
     '''
     if isVerbose:
         print_info('Retrieve existing resource files')
         
-    resources: List[Path] = path.glob('**/*.html')
-    return [
-        Resource(
-            content=resource.read_text(encoding='utf8'),
-            name=resource.name)
-        for resource in resources]
+    return list(path.glob('**/*.html'))
 
 
-def get_sorted_resources(resources: List[Resource]) -> List[Resource]:
-    '''Link all provided resource by alphabetical order
+def get_sorted_resources(resources: List[Path]) -> List[Path]:
+    '''Link all provided resource files by alphabetical order
     
-    :param resources: The list of all resources to sort
+    :param resources: The list of all resource files to sort
     
-    :return: A list of the same resources sorted by alphabetical order
+    :return: A list of the same resource files sorted by alphabetical order
     '''
     if isVerbose:
         print_info('Sort resources')
         
-    # Make a copy of all resource
-    sorted_resources = resources[:]
+    return sorted(resources, key=attrgetter('name'))
+
+
+def read_resource(resource: Path) -> Resource:
+    '''Read the provided resource file
     
-    # Sort the copy and return it
-    sorted_resources.sort(key=lambda resource: resource.name)
-    return sorted_resources
+    :param resource: Path of the resource file to read
+    
+    :return: The resource as an object
+    '''
+    return Resource(
+        content=resource.read_bytes().decode('utf-8'),
+        name=resource.name)
+
+
+def iter_resources(resources: List[Path]) -> Iterator[Resource]:
+    '''Read the provided resource files, a few at a time
+    
+    :param resources: The list of all resource files to read
+    
+    :return: An iterator over the resources, in the same order as their files
+    '''
+    files = iter(resources)
+
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+        # Start reading the first files ahead
+        pending = deque(
+            executor.submit(read_resource, resource)
+            for resource in islice(files, READ_WORKERS))
+
+        # Each time a resource is consumed, start reading the next file so
+        # that only a bounded number of them are held in memory
+        while pending:
+            read = pending.popleft()
+            for resource in islice(files, 1):
+                pending.append(executor.submit(read_resource, resource))
+            yield read.result()
 
 
 def get_module(module: Path) -> Module:
@@ -88,11 +137,13 @@ def get_module(module: Path) -> Module:
     if isVerbose:
         print_info('Retrieve module configuration file')
         
-    # Get all YAML files
-    module_conf_files = [
-        file 
-        for file in module.glob('**/*')
-        if file.is_file() and file.suffix in ['.yml', '.yaml']]
+    # Get the YAML files, stopping as soon as a second one is found
+    module_conf_files = list(islice(
+        (
+            file
+            for file in chain(module.glob('**/*.yml'), module.glob('**/*.yaml'))
+            if file.is_file()),
+        2))
     
     # Assert there is only a unique YAML file for the current module
     if len(module_conf_files) < 1:
@@ -109,8 +160,16 @@ def get_module_data(module_file: Path) -> Module:
     if isVerbose:
         print_info('Extract module\'s data')
         
+    import yaml
+
+    # Use the libyaml based loader when PyYAML has been built against it
+    try:
+        from yaml import CSafeLoader as YamlLoader
+    except ImportError:
+        from yaml import SafeLoader as YamlLoader
+
     # Extract file data
-    data = yaml.safe_load(module_file.read_text(encoding='utf8'))
+    data = yaml.load(module_file.read_text(encoding='utf8'), Loader=YamlLoader)
     
     # Assert that each property is present
     if 'module' not in data.keys():
@@ -134,12 +193,12 @@ def print_info(message: str) -> None:
 
 def record_module(
     module: Module, subscription_plan_id: int,
-    config: dict = extract_config()) -> int:
+    cur: psycopg2.extensions.cursor) -> int:
     '''Record the provided module in database
     
     :param module: Module to record in database
     :param subscription_plan_id: Id of its associated subscription plan
-    :param config: Postgresql connection parameters
+    :param cur: Cursor of the opened database connection
     
     :return: The newly inserted module id
     '''
@@ -151,91 +210,116 @@ def record_module(
        VALUES(%s, %s, %s) RETURNING "Id";
     '''
     
-    conn = None
-    module_id = 0
-    try:
-        # Connect to the PostgreSQL database
-        conn = psycopg2.connect(**config)
-        # Create a new cursor
-        cur = conn.cursor()
-        # Execute the INSERT statement
-        cur.execute(sql, (module.description, subscription_plan_id, module.name))
-        # get the generated id back
-        module_id = int(cur.fetchone()[0])
-        # Commit the changes to the database
-        conn.commit()
-        # Close communication with the database
-        cur.close()
-    finally:
-        if conn is not None:
-            conn.close()
+    # Execute the INSERT statement
+    cur.execute(sql, (module.description, subscription_plan_id, module.name))
+    # get the generated id back
+    return int(cur.fetchone()[0])
+
+
+def reserve_resource_ids(
+        count: int, cur: psycopg2.extensions.cursor) -> List[int]:
+    '''Reserve ids for resources that are about to be recorded
+
+    :param count: Number of ids to reserve
+    :param cur: Cursor of the opened database connection
+
+    :return: The reserved ids, in ascending order
+    '''
+    if count < 1:
+        return []
+
+    # Resolve the sequence backing the "Id" column instead of relying on its
+    # generated name
+    sql = '''
+       SELECT nextval(pg_get_serial_sequence('"resource"', 'Id'))
+       FROM generate_series(1, %s);
+    '''
+
+    cur.execute(sql, (count,))
+    return [int(row[0]) for row in cur.fetchall()]
+
+
+def insert_resource_rows(
+        rows: List[tuple], cur: psycopg2.extensions.cursor) -> None:
+    '''Record the provided resource rows using a multi-row INSERT
     
-    return module_id
+    :param rows: Rows to record, as ("Id", "ModuleId", "Content",
+                 "NextResourceId") tuples
+    :param cur: Cursor of the opened database connection
+    '''
+    from psycopg2.extras import execute_values
+
+    sql = '''
+       INSERT INTO "resource" ("Id", "ModuleId", "Content", "NextResourceId")
+       VALUES %s;
+    '''
+
+    # Rows are sent from the last one so that, when split across several
+    # statements, no resource references one that is not inserted yet
+    execute_values(cur, sql, reversed(rows), page_size=1000)
 
 
-def record_resource(
-    resource: Resource, module_id: int, next_resource_id: int,
-    config: dict = extract_config()) -> int:
-    '''Record the provided resource in database
+def format_copy_row(row: tuple) -> str:
+    '''Format a row as a line of COPY text format
     
-    :param resource: Resource to record in database
-    :param module_id: Id of the module this resource is related to
-    :param next_resource_id: Id of the resource following this one, None if
-                             this resource is the last one
-    :param config: Postgresql connection parameters
+    :param row: Row to format
     
-    :return: The newly inserted resource id
+    :return: The row values separated by tabulations, with NULL values as \\N
     '''
-    if isVerbose:
-        print_info(f'Record the resource from {resource.name}')
+    return '\t'.join(
+        '\\N' if value is None else str(value).translate(COPY_ESCAPES)
+        for value in row) + '\n'
+
+
+def copy_resource_rows(
+        rows: Iterable[tuple], cur: psycopg2.extensions.cursor) -> None:
+    '''Record the provided resource rows using COPY
     
+    :param rows: Rows to record, as ("Id", "ModuleId", "Content",
+                 "NextResourceId") tuples
+    :param cur: Cursor of the opened database connection
+    '''
     sql = '''
-       INSERT INTO "resource" ("ModuleId", "Content", "NextResourceId")
-       VALUES(%s, %s, %s) RETURNING "Id";
+       COPY "resource" ("Id", "ModuleId", "Content", "NextResourceId")
+       FROM STDIN;
     '''
-    conn = None
-    resource_id = 0
-    try:
-        # Connect to the PostgreSQL database
-        conn = psycopg2.connect(**config)
-        # Create a new cursor
-        cur = conn.cursor()
-        # Execute the INSERT statement
-        cur.execute(sql, (module_id, resource.content, next_resource_id))
-        # get the generated id back
-        resource_id = int(cur.fetchone()[0])
-        # Commit the changes to the database
-        conn.commit()
-        # Close communication with the database
-        cur.close()
-    finally:
-        if conn is not None:
-            conn.close()
 
-    return resource_id
+    # Rows are formatted only when COPY asks for more data, so that only the
+    # resources being sent are held in memory
+    cur.copy_expert(sql, IteratorReader(map(format_copy_row, rows)))
 
 
 def record_resources(
-        resources: List[Resource], module_id: int,
-        config: dict = extract_config()) -> None:
+        resources: List[Path], module_id: int,
+        cur: psycopg2.extensions.cursor) -> None:
     '''Record the provided resources in database
     
-    :param resources: The list of all Resource objects to insert
+    :param resources: The sorted list of all resource files to insert
     :param module_id: Id of the module this resource is related to
-    :param config: Postgresql connection parameters
+    :param cur: Cursor of the opened database connection
     '''
     if isVerbose:
         print_info('Start recording resources')
-        
-    # Since all resources are linked to each other, we need the index of the
-    # second resource to track the first
-    # To achieve that, we need to invert the order and start tracking the last
-    # which is not linked to any other resource
-    resources = resources[::-1]
-    
-    next_resource_id = None
-    for resource in resources:
-        next_resource_id = record_resource(resource, module_id, next_resource_id, config)
+
+    # Since all resources are linked to each other, each one has to point to
+    # the id of the one following it
+    # To avoid inserting them one by one from the last one, all their ids are
+    # reserved beforehand
+    ids = reserve_resource_ids(len(resources), cur)
+
+    # Build all resources rows, already linked to each other, reading each
+    # resource file only when its row is consumed
+    # The last resource is not followed by any other one
+    next_ids = chain(islice(ids, 1, None), (None,))
+    rows = (
+        (resource_id, module_id, resource.content, next_id)
+        for resource_id, next_id, resource
+        in zip(ids, next_ids, iter_resources(resources)))
+
+    if len(resources) < COPY_THRESHOLD:
+        insert_resource_rows(list(rows), cur)
+    else:
+        copy_resource_rows(rows, cur)
 
     if isVerbose:
         print_info('End resources recording')
@@ -270,21 +354,32 @@ def upload(path, module, subscription_plan_id, verbose):
 
     root_path = Path(path)
     
-    # Retrieve all resources
+    # Retrieve all resource files, without reading them yet
     resources: List[Path] = get_resources(root_path)
     
-    # Sort and link them
+    # Sort them by name before linking them
     resources = get_sorted_resources(resources)
 
     # Retrieve module meta data
     module_path = Path(module if module else path)
     module = get_module(module_path)
     
-    # Add a new record for the module
-    module_id = record_module(module, subscription_plan_id)
-    
-    # Add a new track for all its associated resources
-    record_resources(resources, module_id)
+    import psycopg2
+
+    # Connect to the PostgreSQL database, sharing the same connection for the
+    # module and its resources
+    conn = psycopg2.connect(**extract_config())
+    try:
+        # Record everything in a single transaction, committed once on
+        # success and rolled back on any error
+        with conn, conn.cursor() as cur:
+            # Add a new record for the module
+            module_id = record_module(module, subscription_plan_id, cur)
+
+            # Add a new track for all its associated resources
+            record_resources(resources, module_id, cur)
+    finally:
+        conn.close()
 
     if isVerbose:
         print_info('Done !')
@@ -1,14 +1,14 @@
 from dataclasses import dataclass
 
 
-@dataclass(init=True)
+@dataclass(init=True, frozen=True, slots=True)
 class Resource:
     '''Represent a resource of a module'''
     content: str
     name: str
 
 
-@dataclass(init=True)
+@dataclass(init=True, frozen=True, slots=True)
 class Module:
     '''Represent a module'''
     description: str
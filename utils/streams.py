@@ -0,0 +1,43 @@
+from typing import Iterable
+
+
+class IteratorReader:
+    '''Expose an iterator of strings as a readable file-like object'''
+
+    def __init__(self, chunks: Iterable[str]):
+        '''Wrap the provided chunks
+
+        :param chunks: Strings to read, consumed only when requested
+        '''
+        self._chunks = iter(chunks)
+        self._chunk = ''
+        self._offset = 0
+
+    def read(self, size: int = -1) -> str:
+        '''Read up to size characters, or everything left if size is negative
+
+        :param size: Maximum number of characters to read
+
+        :return: The characters read, an empty string once exhausted
+        '''
+        parts = []
+
+        while size != 0:
+            # Move on to the next chunk once the current one is consumed
+            if self._offset >= len(self._chunk):
+                self._chunk = next(self._chunks, None)
+                self._offset = 0
+                if self._chunk is None:
+                    self._chunk = ''
+                    break
+                continue
+
+            end = len(self._chunk) if size < 0 \
+                else min(len(self._chunk), self._offset + size)
+            parts.append(self._chunk[self._offset:end])
+
+            if size > 0:
+                size -= end - self._offset
+            self._offset = end
+
+        return ''.join(parts)